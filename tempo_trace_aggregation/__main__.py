@@ -25,8 +25,11 @@ from typing import Dict, Any
 
 import yaml
 
-from tempo_trace_aggregation.collect import TempoTraces, NodeGraphAPI, RestConnection
+from tempo_trace_aggregation.client import TempoClient
+from tempo_trace_aggregation.collect import TempoTraces, NodeGraphAPI, RestConnection, Shard, TagValues, \
+    SHARD_BY_TRACE_ID, SHARD_BY_TAG_VALUE
 from tempo_trace_aggregation.logging import Log
+from tempo_trace_aggregation.shard import DirectoryExchange, HttpExchange, Merger
 
 log = Log(__name__)
 
@@ -39,6 +42,36 @@ class MissingArgument(Exception):
         return self.argument
 
 
+class InvalidArgument(Exception):
+    def __init__(self, argument: str):
+        self.argument = argument
+
+    def get_invalid(self):
+        return self.argument
+
+
+def validate_shard(shard: Dict[str, Any]):
+    """
+    Validate the shard configuration, the merger role is only set with the --shard_merger argument so a
+    configuration file can be shared by all the instances
+    """
+    try:
+        count = int(shard['count'])
+        index = int(shard['index'])
+    except ValueError:
+        raise InvalidArgument("Configuration for \"shard\"->\"count\" and \"shard\"->\"index\" must be integers")
+    if count < 1 or not 0 <= index < count:
+        raise InvalidArgument(f"Shard index {index} must be in the range 0 to shard count {count} - 1")
+    if shard['by'] not in [SHARD_BY_TRACE_ID, SHARD_BY_TAG_VALUE]:
+        raise InvalidArgument(f"Configuration for \"shard\"->\"by\" must be {SHARD_BY_TRACE_ID} or {SHARD_BY_TAG_VALUE}")
+    if 'directory' in shard:
+        return
+    if shard['merger'] and not shard.get('listen'):
+        raise InvalidArgument("The shard merger must have \"shard\"->\"listen\" or \"shard\"->\"directory\"")
+    if not shard['merger'] and not shard.get('merger_url'):
+        raise InvalidArgument("A shard must have \"shard\"->\"merger_url\" or \"shard\"->\"directory\"")
+
+
 def resolve(arguments: {}, config_object: str, attribute: str, arg, default=None):
     if arg:
         if config_object not in arguments:
@@ -95,6 +128,15 @@ def argument_parser() -> Dict[str, Any]:
                         dest="search_mode",
                         help="the Tempo search mode, available values are blocks, ingesters or all, default ingester")
 
+    parser.add_argument('-N', '--shard_count',
+                        dest="shard_count", help="the number of tta instances sharing the work, default 1")
+
+    parser.add_argument('-i', '--shard_index',
+                        dest="shard_index", help="the shard index, 0 to shard_count - 1, of this instance, default 0")
+
+    parser.add_argument('-M', '--shard_merger', action='store_true',
+                        dest="shard_merger", help="this instance merge the partials of all shards, default false")
+
     args = parser.parse_args()
     if not args.config:
         parser.print_help()
@@ -118,17 +160,30 @@ def argument_parser() -> Dict[str, Any]:
         resolve(parsed_yaml, 'query', 'use_tag_as_node', args.use_tag_as_node, False)
         resolve(parsed_yaml, 'query', 'trace_threshold_ms', args.trace_threshold_ms, '40.0')
         resolve(parsed_yaml, 'query', 'service_node_sub_title', args.service_node_sub_title, 'Service Node')
+        resolve(parsed_yaml, 'query', 'tag_values_ttl', None, '300')
         resolve(parsed_yaml, 'loop', 'interval', args.loop_interval, '0')
         resolve(parsed_yaml, 'search', 'from', args.search_from, '7200')
         resolve(parsed_yaml, 'search', 'mode', args.search_mode, 'ingesters')
+        if 'shard' in parsed_yaml or args.shard_count:
+            resolve(parsed_yaml, 'shard', 'count', args.shard_count, '1')
+            resolve(parsed_yaml, 'shard', 'index', args.shard_index, '0')
+            resolve(parsed_yaml, 'shard', 'by', None, SHARD_BY_TRACE_ID)
+            if 'merger' in parsed_yaml['shard']:
+                raise InvalidArgument("The shard merger can only be set with the argument --shard_merger")
+            parsed_yaml['shard']['merger'] = bool(args.shard_merger)
+            validate_shard(parsed_yaml['shard'])
     except MissingArgument as err:
         print(f"error - {err.get_missing()}")
         parser.print_help()
         exit(1)
+    except InvalidArgument as err:
+        print(f"error - {err.get_invalid()}")
+        parser.print_help()
+        exit(1)
 
     info = {}
     for key in parsed_yaml.keys():
-        if key in ['graph', 'query', 'loop', 'search']:
+        if key in ['graph', 'query', 'loop', 'search', 'shard', 'limits']:
             info[key] = parsed_yaml[key]
 
     log.info_fmt(info, "configuration")
@@ -150,24 +205,77 @@ if __name__ == "__main__":
     if 'timeout' in conf['tempo']:
         tempo_con.timeout = conf['tempo']['timeout']
 
+    limits = conf.get('limits') or {}
+
+    # Created once so the rate limit and circuit breaker state is kept between the loops
+    tempo_client = TempoClient(tempo_con,
+                               rate_limit=float(conf['tempo'].get('rate_limit', 0.0)),
+                               rate_burst=int(conf['tempo'].get('rate_burst', 1)),
+                               retries=int(conf['tempo'].get('retries', 3)),
+                               backoff=float(conf['tempo'].get('backoff', 0.5)),
+                               backoff_max=float(conf['tempo'].get('backoff_max', 10.0)),
+                               circuit_failures=int(conf['tempo'].get('circuit_failures', 5)),
+                               circuit_reset=float(conf['tempo'].get('circuit_reset', 30.0)),
+                               max_response_bytes=int(limits.get('max_response_bytes', 0)))
+
+    # Created once so the tag values are cached between the loops
+    tag_values = TagValues(graph=conf['graph']['name'], client=tempo_client, tag=conf['query']['tag'],
+                           tag_filter=conf['query']['tag_filter'], ttl=float(conf['query']['tag_values_ttl']))
+
+    shard = None
+    exchange = None
+    merger = None
+    if 'shard' in conf:
+        shard = Shard(index=int(conf['shard']['index']), count=int(conf['shard']['count']), by=conf['shard']['by'])
+        if 'directory' in conf['shard']:
+            exchange = DirectoryExchange(graph=conf['graph']['name'], shard=shard,
+                                         directory=conf['shard']['directory'])
+        else:
+            exchange = HttpExchange(graph=conf['graph']['name'], shard=shard,
+                                    merger_url=conf['shard'].get('merger_url', ''),
+                                    listen=conf['shard'].get('listen', '') if conf['shard']['merger'] else '')
+        if conf['shard']['merger']:
+            merger = Merger(graph=conf['graph']['name'], shard=shard, exchange=exchange,
+                            trace_threshold_ms=float(conf['query']['trace_threshold_ms']),
+                            max_age=float(conf['shard'].get('max_age', max(120, 2 * int(conf['loop']['interval'])))),
+                            wait=float(conf['shard'].get('wait', 30)),
+                            max_nodes=int(limits.get('max_nodes', 0)),
+                            max_edges=int(limits.get('max_edges', 0)))
+
     while True:
         tempo = TempoTraces(graph=conf['graph']['name'], connection=tempo_con,
                             tag=conf['query']['tag'],
                             tag_filter=conf['query']['tag_filter'],
                             use_tag_as_node=conf['query']['use_tag_as_node'],
                             service_node_sub_title=conf['query']['service_node_sub_title'],
-                            trace_threshold_ms=float(conf['query']['trace_threshold_ms']))
-
-        nodes, edges = tempo.execute(start_time=int(time.time() - float(conf['search']['from'])),
-                                     end_time=int(time.time()),
-                                     search_mode=conf['search']['mode'])
-
-        nodeprovider = NodeGraphAPI(graph=conf['graph']['name'], connection=nodegraph_provider_con)
-
-        if nodes and edges:
-            nodeprovider.batch_update_nodes(nodes=nodes, edges=edges)
-        else:
-            nodeprovider.delete_graph()
+                            trace_threshold_ms=float(conf['query']['trace_threshold_ms']),
+                            client=tempo_client,
+                            shard=shard,
+                            tag_values=tag_values,
+                            max_spans=int(limits.get('max_spans', 0)),
+                            max_nodes=int(limits.get('max_nodes', 0)),
+                            max_edges=int(limits.get('max_edges', 0)))
+
+        partial = tempo.collect(start_time=int(time.time() - float(conf['search']['from'])),
+                                end_time=int(time.time()),
+                                search_mode=conf['search']['mode'])
+
+        if exchange:
+            exchange.publish(partial)
+
+        # Only the merger push to the nodegraph_provider when sharded
+        if not shard or merger:
+            if merger:
+                nodes, edges = merger.merge()
+            else:
+                nodes, edges = partial.to_graph(tempo.trace_threshold_ms)
+
+            nodeprovider = NodeGraphAPI(graph=conf['graph']['name'], connection=nodegraph_provider_con)
+
+            if nodes and edges:
+                nodeprovider.batch_update_nodes(nodes=nodes, edges=edges)
+            else:
+                nodeprovider.delete_graph()
 
         if int(conf['loop']['interval']) == 0:
             break
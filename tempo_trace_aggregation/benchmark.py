@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2022  Anders Håål and Redbridge AB
+
+    This file is part of tta - Tempo trace aggregation.
+
+    indis is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    indis is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tta.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import argparse
+import random
+import time
+from hashlib import md5
+from typing import List, Dict, Any, Set, Tuple
+
+from tempo_trace_aggregation.collect import Node, Edge
+from tempo_trace_aggregation.spans import SpanBuffer, np
+
+SERVICES = ['frontend', 'api-gateway', 'customers', 'visits', 'vets', 'database', 'cache', 'auth']
+SPAN_NAMES = ['GET /', 'POST /', 'query', 'select', 'insert', 'get', 'set', 'validate', 'render', 'send']
+
+
+def generate(traces: int, spans_per_trace: int, seed: int = 1) -> List[Dict[str, Any]]:
+    rnd = random.Random(seed)
+    spans = []
+    for trace in range(traces):
+        span_ids = []
+        for index in range(spans_per_trace):
+            span_id = f"{trace:016x}{index:08x}"
+            start = rnd.randint(0, 10 ** 12)
+            span = {'service': rnd.choice(SERVICES), 'name': rnd.choice(SPAN_NAMES), 'spanId': span_id,
+                    'startTimeUnixNano': str(start), 'endTimeUnixNano': str(start + rnd.randint(10 ** 5, 10 ** 9))}
+            if span_ids:
+                span['parentSpanId'] = rnd.choice(span_ids)
+            span_ids.append(span_id)
+            spans.append(span)
+    return spans
+
+
+def run_baseline(spans: List[Dict[str, Any]]) -> Tuple[float, float]:
+    """
+    The per span loop that was used before the span buffer, with Node objects updated one span at a time
+    :return: the time of the span loop and the time to create the edges
+    """
+    start = time.perf_counter()
+    nodes: Dict[str, Node] = {}
+    span_to_node: Dict[str, Set[str]] = {}
+    node_span_parent: Dict[str, Set[str]] = {}
+    for span in spans:
+        node_id = md5(str.encode(f"{span['service']}##{span['name']}")).hexdigest()
+        if node_id not in nodes:
+            node = Node()
+            node.id = node_id
+            node.title = span['service']
+            node.subTitle = span['name']
+            nodes[node_id] = node
+        node = nodes[node_id]
+        node.mainStat += 1
+        node.secondaryStat += ((node.secondaryStat + float(span['endTimeUnixNano']) - float(
+            span['startTimeUnixNano'])) / node.mainStat) / 1000000
+        if node.secondaryStat > 40.0:
+            node.arc__failed = 1.0
+            node.arc__passed = 0.0
+        else:
+            node.arc__failed = 0.0
+            node.arc__passed = 1.0
+        if 'parentSpanId' in span:
+            if node_id not in node_span_parent:
+                node_span_parent[node_id] = set()
+            node_span_parent[node_id].add(span['parentSpanId'])
+        if span['spanId'] not in span_to_node:
+            span_to_node[span['spanId']] = set()
+        span_to_node[span['spanId']].add(node_id)
+    filled = time.perf_counter()
+
+    edges: Dict[str, Edge] = {}
+    for node_id_target, parent_spans in node_span_parent.items():
+        for span_id in parent_spans:
+            for node_id_source in span_to_node.get(span_id, ()):
+                edge_id = f"{node_id_source}#{node_id_target}"
+                if edge_id not in edges:
+                    edge = Edge()
+                    edge.source = node_id_source
+                    edge.target = node_id_target
+                    edges[edge_id] = edge
+                edges[edge_id].mainStat += 1
+    return filled - start, time.perf_counter() - filled
+
+
+def run(spans: List[Dict[str, Any]], use_numpy: bool) -> Tuple[float, float]:
+    """
+    :return: the time to fill the buffer and the time to aggregate it
+    """
+    start = time.perf_counter()
+    buffer = SpanBuffer(use_numpy=use_numpy)
+    for span in spans:
+        node = buffer.node(span['service'], span['name'])
+        buffer.append(node, span['spanId'], span.get('parentSpanId'), start=int(span['startTimeUnixNano']),
+                      end=int(span['endTimeUnixNano']))
+    filled = time.perf_counter()
+    buffer.aggregate()
+    return filled - start, time.perf_counter() - filled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='tta - span aggregation benchmark')
+    parser.add_argument('-t', '--traces', dest="traces", type=int, default=2000, help="number of traces")
+    parser.add_argument('-s', '--spans', dest="spans", type=int, default=50, help="number of spans per trace")
+    parser.add_argument('-r', '--rounds', dest="rounds", type=int, default=3, help="number of rounds, best is used")
+    args = parser.parse_args()
+
+    all_spans = generate(args.traces, args.spans)
+    modes = [('baseline', lambda: run_baseline(all_spans)), ('python', lambda: run(all_spans, False))]
+    if np is not None:
+        modes.append(('numpy', lambda: run(all_spans, True)))
+    else:
+        print("numpy is not installed, only the baseline and python aggregation are measured")
+
+    for mode, runner in modes:
+        fill, aggregate = min((runner() for _ in range(args.rounds)), key=sum)
+        print(f"{mode:<8} spans={len(all_spans)} fill={fill:.3f}s aggregate={aggregate:.3f}s "
+              f"spans/s={len(all_spans) / (fill + aggregate):,.0f} aggregate spans/s={len(all_spans) / aggregate:,.0f}")
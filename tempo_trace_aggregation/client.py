@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2022  Anders Håål and Redbridge AB
+
+    This file is part of tta - Tempo trace aggregation.
+
+    indis is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    indis is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tta.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import json
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Optional
+
+import requests
+
+from tempo_trace_aggregation.logging import Log
+
+log = Log(__name__)
+
+# Status codes where a new attempt may succeed
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+CHUNK_SIZE = 64 * 1024
+
+
+class EmptyResponse(Exception):
+    pass
+
+
+class TempoCallFailed(Exception):
+    def __init__(self, url_path: str, reason: str, status: int = None, unhealthy: bool = False):
+        super().__init__(reason)
+        self.url_path = url_path
+        self.reason = reason
+        self.status = status
+        # True if the failure is a sign that Tempo is degraded, counted by the circuit breaker
+        self.unhealthy = unhealthy
+
+
+class CircuitOpen(TempoCallFailed):
+    pass
+
+
+class ResponseTooLarge(TempoCallFailed):
+    pass
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Every request take one token, tokens are refilled with rate per second up
+    to burst. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate: float = 0.0, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens: float = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Block until a token is available
+        :return: the number of seconds waited
+        """
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(float(self.burst), self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return waited
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class CircuitBreaker:
+    """
+    Open the circuit after failure_threshold consecutive failed calls, where a call is failed when all its
+    retries failed or the connection broke. When open all calls are shed until
+    reset_timeout seconds has passed, then a single trial call is let through (half open). A successful trial
+    close the circuit, a failed one open it again.
+    A failure_threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CIRCUIT_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if self.failure_threshold <= 0:
+            return True
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            if self.state == CIRCUIT_OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = CIRCUIT_HALF_OPEN
+                self._trial_in_progress = False
+                log.info_fmt({'circuit': self.state}, "Tempo circuit breaker")
+            if self.state == CIRCUIT_HALF_OPEN and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self.state != CIRCUIT_CLOSED:
+                self.state = CIRCUIT_CLOSED
+                self._trial_in_progress = False
+                log.info_fmt({'circuit': self.state}, "Tempo circuit breaker")
+
+    def record_failure(self):
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            self._failures += 1
+            if self.state == CIRCUIT_HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != CIRCUIT_OPEN:
+                    log.warn_fmt({'circuit': CIRCUIT_OPEN, 'failures': self._failures,
+                                  'reset_timeout': self.reset_timeout}, "Tempo circuit breaker")
+                self.state = CIRCUIT_OPEN
+                self._opened_at = time.monotonic()
+                self._trial_in_progress = False
+
+
+class CallCounters:
+    def __init__(self):
+        self.requests: int = 0
+        self.retries: int = 0
+        self.throttled: int = 0
+        self.failed: int = 0
+        self.shed: int = 0
+        self.oversized: int = 0
+        self.rate_limit_wait: float = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, attribute: str, value=1):
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + value)
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.retries = 0
+            self.throttled = 0
+            self.failed = 0
+            self.shed = 0
+            self.oversized = 0
+            self.rate_limit_wait = 0.0
+
+    def to_log(self) -> Dict[str, Any]:
+        return {'requests': self.requests, 'retries': self.retries, 'throttled': self.throttled,
+                'dropped': self.failed + self.shed + self.oversized, 'shed': self.shed, 'oversized': self.oversized,
+                'rate_limit_wait': round(self.rate_limit_wait, 3)}
+
+
+class TempoClient:
+    """
+    The http layer against Tempo with rate limit, retries with jittered exponential backoff and a circuit breaker.
+    A response body is bounded by max_response_bytes, 0 is no limit, and a response larger than that is dropped.
+    Collect fetch one trace at a time and the body is released when the spans are in the span buffer, so
+    max_response_bytes is also the bound of the response bytes held in memory by a collect.
+    The client should be created once and shared between collect cycles so the breaker and the rate limit state
+    survive between cycles.
+    """
+
+    def __init__(self, connection, rate_limit: float = 0.0, rate_burst: int = 1, retries: int = 3,
+                 backoff: float = 0.5, backoff_max: float = 10.0, circuit_failures: int = 5,
+                 circuit_reset: float = 30.0, max_response_bytes: int = 0):
+        self._connection = connection
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.bucket = TokenBucket(rate=rate_limit, burst=rate_burst)
+        self.breaker = CircuitBreaker(failure_threshold=circuit_failures, reset_timeout=circuit_reset)
+        self.counters = CallCounters()
+        self.max_response_bytes = max_response_bytes
+        self._session = requests.Session()
+
+    def fork(self) -> 'TempoClient':
+        """
+        Create a client for calls done in another thread. The fork share the rate limit, the circuit breaker and
+        the limits with this client, but has its own http session, since a requests.Session is not thread safe,
+        and its own counters.
+        """
+        client = TempoClient(self._connection, retries=self.retries, backoff=self.backoff,
+                             backoff_max=self.backoff_max, max_response_bytes=self.max_response_bytes)
+        client.bucket = self.bucket
+        client.breaker = self.breaker
+        return client
+
+    def get(self, url_path: str) -> Dict[str, Any]:
+        """
+        Get the json response for the url_path
+        :param url_path: the path relative to the tempo url
+        :return: the decoded json response
+        :raise EmptyResponse: if tempo answer 200 without any content or 404
+        :raise TempoCallFailed: if all attempts failed, the call was shed by the circuit breaker or the response
+        was too large
+        """
+        if not self.breaker.allow():
+            self.counters.add('shed')
+            raise CircuitOpen(url_path, "Circuit breaker open")
+
+        # The breaker count calls, not attempts, and every allowed call must record an outcome so a half open
+        # trial is always completed
+        healthy = False
+        try:
+            response = self._attempts(url_path)
+            healthy = True
+            return response
+        except EmptyResponse:
+            healthy = True
+            raise
+        except TempoCallFailed as err:
+            healthy = not err.unhealthy
+            raise
+        finally:
+            if healthy:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    def _attempts(self, url_path: str) -> Dict[str, Any]:
+        attempt = 0
+        while True:
+            self.counters.add('rate_limit_wait', self.bucket.acquire())
+            self.counters.add('requests')
+            retry_after = None
+            try:
+                r = self._session.get(url=f"{self._connection.url}{url_path}", headers=self._connection.headers,
+                                      timeout=self._connection.timeout, stream=True)
+                if r.status_code == 200:
+                    content = self._read(r, url_path)
+                    response = json.loads(content) if content else None
+                    if response:
+                        return response
+                    raise EmptyResponse()
+                r.close()
+                if r.status_code not in RETRYABLE_STATUS:
+                    # Tempo is answering, e.g. 404 for a trace not found, so it is not a sign of degradation
+                    if r.status_code == 404:
+                        raise EmptyResponse()
+                    self.counters.add('failed')
+                    raise TempoCallFailed(url_path, "Not a expected response", r.status_code)
+                if r.status_code == 429:
+                    self.counters.add('throttled')
+                retry_after = self._retry_after(r.headers.get('Retry-After'))
+                reason = "Not a expected response"
+                status = r.status_code
+            except ResponseTooLarge:
+                self.counters.add('oversized')
+                raise
+            except (EmptyResponse, TempoCallFailed):
+                raise
+            except (requests.ConnectionError, requests.Timeout) as err:
+                reason = err.__str__()
+                status = None
+            except requests.RequestException as err:
+                # E.g. a broken chunked response or too many redirects, not worth a retry
+                self.counters.add('failed')
+                raise TempoCallFailed(url_path, err.__str__(), unhealthy=True)
+            except ValueError as err:
+                # Invalid json
+                self.counters.add('failed')
+                raise TempoCallFailed(url_path, err.__str__())
+
+            if retry_after is not None and retry_after > self.backoff_max:
+                # Never retry before Tempo asked for, a longer wait than backoff_max fail the call
+                self.counters.add('failed')
+                raise TempoCallFailed(url_path, f"Retry-After {round(retry_after, 3)}s is longer than backoff_max",
+                                      status, unhealthy=True)
+            if attempt >= self.retries:
+                self.counters.add('failed')
+                raise TempoCallFailed(url_path, reason, status, unhealthy=True)
+
+            delay = self._backoff(attempt)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            attempt += 1
+            self.counters.add('retries')
+            log.debug_fmt({'url': url_path, 'status': status, 'attempt': attempt, 'delay': round(delay, 3)},
+                          "Retry tempo call")
+            time.sleep(delay)
+
+    def _read(self, r, url_path: str) -> bytes:
+        """
+        Read the response body within max_response_bytes
+        """
+        length = r.headers.get('Content-Length')
+        if self.max_response_bytes and length and length.isdigit() and int(length) > self.max_response_bytes:
+            r.close()
+            raise ResponseTooLarge(url_path, f"Response of {length} bytes is larger than {self.max_response_bytes}")
+
+        chunks = []
+        size = 0
+        try:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                if self.max_response_bytes and size + len(chunk) > self.max_response_bytes:
+                    raise ResponseTooLarge(url_path, f"Response is larger than {self.max_response_bytes} bytes")
+                size += len(chunk)
+                chunks.append(chunk)
+        finally:
+            r.close()
+        return b''.join(chunks)
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter, https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+
+    @staticmethod
+    def _retry_after(value: Optional[str]) -> Optional[float]:
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
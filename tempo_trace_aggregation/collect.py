@@ -22,11 +22,14 @@
 import base64
 import json
 import re
+import threading
 import time
 from hashlib import md5
-from typing import List, Dict, Any, Set, Tuple
+from typing import List, Dict, Any, Set, Tuple, Optional
 import requests
+from tempo_trace_aggregation.client import TempoClient, EmptyResponse, TempoCallFailed, CircuitOpen
 from tempo_trace_aggregation.logging import Log
+from tempo_trace_aggregation.spans import SpanBuffer, NO_INDEX, OTHER_TITLE, OTHER_SUB_TITLE
 
 TWO_HOURS = 7200.0
 
@@ -35,9 +38,14 @@ log = Log(__name__)
 EMPTY_RESPONSE = 'No traces found'
 SERVICE_NODE_SUB_TITLE = "Service Node"
 
+SHARD_BY_TAG_VALUE = 'tag_value'
+SHARD_BY_TRACE_ID = 'trace_id'
 
-class EmptyResponse(Exception):
-    pass
+# The limits that can make a graph partial
+DEGRADED_SPANS = 'spans'
+DEGRADED_NODES = 'nodes'
+DEGRADED_EDGES = 'edges'
+DEGRADED_RESPONSES = 'responses'
 
 
 class RestConnection:
@@ -102,40 +110,348 @@ class Edge:
         return params
 
 
+def _is_count(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class PartialGraph:
+    """
+    Mergeable aggregation state of a collect. A node keep the number of spans and the sum of the span durations,
+    and an edge the number of parent spans between two nodes, so partials from different shards can be added
+    together before the graph is created. An edge from a service node is only a link and is counted once.
+    The degraded set hold the limits that was hit, if not empty the graph is partial.
+    """
+
+    def __init__(self):
+        self.nodes: Dict[str, Dict[str, Any]] = {}
+        self.edges: Dict[str, Dict[str, Any]] = {}
+        self.degraded: Set[str] = set()
+
+    def add_node(self, node_id: str, title: str, sub_title: str, service: bool = False):
+        if node_id not in self.nodes:
+            self.nodes[node_id] = {'title': title, 'subTitle': sub_title, 'count': 0, 'duration_ms': 0.0,
+                                   'service': service}
+
+    def add_span(self, node_id: str, duration_ms: float, count: int = 1):
+        node = self.nodes[node_id]
+        node['count'] += count
+        node['duration_ms'] += duration_ms
+
+    def add_edge(self, source: str, target: str, count: int = 1):
+        edge_id = f"{source}#{target}"
+        if edge_id not in self.edges:
+            self.edges[edge_id] = {'source': source, 'target': target, 'count': 0}
+        if self.nodes.get(source, {}).get('service'):
+            self.edges[edge_id]['count'] = 1
+        else:
+            self.edges[edge_id]['count'] += count
+
+    def merge(self, other: 'PartialGraph'):
+        for node_id, node in other.nodes.items():
+            self.add_node(node_id, node['title'], node['subTitle'], node.get('service', False))
+            self.add_span(node_id, node['duration_ms'], node['count'])
+        for edge in other.edges.values():
+            self.add_edge(edge['source'], edge['target'], edge['count'])
+        self.degraded.update(other.degraded)
+
+    def limit_edges(self, max_edges: int) -> int:
+        """
+        Keep the max_edges edges with the highest count
+        :return: the number of dropped edges
+        """
+        if not max_edges or len(self.edges) <= max_edges:
+            return 0
+        dropped = len(self.edges) - max_edges
+        keep = sorted(self.edges.items(), key=lambda item: item[1]['count'], reverse=True)[:max_edges]
+        self.edges = dict(keep)
+        self.degraded.add(DEGRADED_EDGES)
+        return dropped
+
+    def limit_nodes(self, max_nodes: int) -> int:
+        """
+        Collapse nodes so the partial has at most max_nodes nodes, with the same rules as the span buffer. Service
+        nodes are never collapsed, the nodes with the highest count are kept and the other nodes are collapsed into
+        the "other" node of their title, or the global "other" node if no node of the title is kept. The limit can
+        not be kept if there are more than max_nodes - 1 service nodes.
+        :return: the number of collapsed nodes
+        """
+        if not max_nodes or len(self.nodes) <= max_nodes:
+            return 0
+        services = [node_id for node_id, node in self.nodes.items() if node.get('service')]
+        # One slot is reserved for the global other node
+        free = max_nodes - len(services) - 1
+        kept: Set[str] = set()
+        titles: Set[str] = set()
+        candidates = sorted((item for item in self.nodes.items() if not item[1].get('service')),
+                            key=lambda item: item[1]['count'], reverse=True)
+        for node_id, node in candidates:
+            # A new title also reserve a slot for its other node
+            cost = 1 if node['title'] in titles else 2
+            if cost <= free:
+                free -= cost
+                kept.add(node_id)
+                titles.add(node['title'])
+
+        nodes, self.nodes = self.nodes, {}
+        mapping: Dict[str, str] = {}
+        for node_id, node in nodes.items():
+            title, sub_title = node['title'], node['subTitle']
+            if not node.get('service') and node_id not in kept:
+                title = title if title in titles else OTHER_TITLE
+                sub_title = OTHER_SUB_TITLE
+                mapping[node_id] = md5(str.encode(f"{title}##{sub_title}")).hexdigest()
+            self.add_node(mapping.get(node_id, node_id), title, sub_title, node.get('service', False))
+            self.add_span(mapping.get(node_id, node_id), node['duration_ms'], node['count'])
+
+        edges, self.edges = self.edges, {}
+        for edge in edges.values():
+            self.add_edge(mapping.get(edge['source'], edge['source']), mapping.get(edge['target'], edge['target']),
+                          edge['count'])
+        collapsed = len(nodes) - len(kept) - len(services)
+        if collapsed:
+            self.degraded.add(DEGRADED_NODES)
+        return collapsed
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'nodes': self.nodes, 'edges': self.edges, 'degraded': sorted(self.degraded)}
+
+    @staticmethod
+    def validate(data: Any):
+        """
+        Validate the structure of a partial created by to_dict, e.g. read from another shard
+        :raise ValueError: if the partial is not valid
+        """
+        if not isinstance(data, dict):
+            raise ValueError("Partial must be an object")
+        nodes = data.get('nodes', {})
+        edges = data.get('edges', {})
+        if not isinstance(nodes, dict) or not isinstance(edges, dict):
+            raise ValueError("Partial nodes and edges must be objects")
+        for node_id, node in nodes.items():
+            if not (isinstance(node, dict) and isinstance(node.get('title'), str)
+                    and isinstance(node.get('subTitle'), str) and _is_count(node.get('count'))
+                    and _is_number(node.get('duration_ms')) and isinstance(node.get('service', False), bool)):
+                raise ValueError(f"Invalid partial node {node_id}")
+        for edge_id, edge in edges.items():
+            if not (isinstance(edge, dict) and isinstance(edge.get('source'), str)
+                    and isinstance(edge.get('target'), str) and _is_count(edge.get('count'))):
+                raise ValueError(f"Invalid partial edge {edge_id}")
+        degraded = data.get('degraded', [])
+        if not isinstance(degraded, list) or not all(isinstance(limit, str) for limit in degraded):
+            raise ValueError("Partial degraded must be a list of strings")
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> 'PartialGraph':
+        partial = PartialGraph()
+        partial.nodes = data.get('nodes', {})
+        partial.edges = data.get('edges', {})
+        partial.degraded = set(data.get('degraded', []))
+        return partial
+
+    def to_graph(self, trace_threshold_ms: float) -> Tuple[List[Node], List[Edge]]:
+        """
+        Create the nodes and edges for the nodegraph_provider
+        :param trace_threshold_ms: the average duration where a node is marked as failed
+        :return: nodes and edges, both empty if the graph has no nodes or no edges
+        """
+        nodes: List[Node] = []
+        for node_id, values in self.nodes.items():
+            node = Node()
+            node.id = node_id
+            node.title = values['title']
+            node.subTitle = values['subTitle']
+            node.mainStat = float(values['count'])
+            if values['count']:
+                node.secondaryStat = values['duration_ms'] / values['count']
+            if node.secondaryStat > trace_threshold_ms:
+                node.arc__failed = 1.0
+                node.arc__passed = 0.0
+            nodes.append(node)
+
+        edges: List[Edge] = []
+        for values in self.edges.values():
+            edge = Edge()
+            edge.source = values['source']
+            edge.target = values['target']
+            edge.mainStat = float(values['count'])
+            edges.append(edge)
+
+        if nodes and edges:
+            return nodes, edges
+        else:
+            return list(), list()
+
+
+class Shard:
+    """
+    The slice of the work owned by a tta instance when collection is sharded over count instances.
+    The work is split by the tag value or by the trace id.
+    """
+
+    def __init__(self, index: int = 0, count: int = 1, by: str = SHARD_BY_TRACE_ID):
+        if by not in [SHARD_BY_TAG_VALUE, SHARD_BY_TRACE_ID]:
+            raise ValueError(f"Shard by must be {SHARD_BY_TAG_VALUE} or {SHARD_BY_TRACE_ID}, not {by}")
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Shard index {index} is not in the range of shard count {count}")
+        self.index = index
+        self.count = count
+        self.by = by
+
+    def owns(self, key: str) -> bool:
+        return int(md5(str.encode(key)).hexdigest(), 16) % self.count == self.index
+
+    def owns_tag_value(self, tag_value: str) -> bool:
+        return self.by != SHARD_BY_TAG_VALUE or self.owns(tag_value)
+
+    def owns_trace(self, trace_id: str) -> bool:
+        return self.by != SHARD_BY_TRACE_ID or self.owns(trace_id)
+
+
+class TagValues:
+    """
+    Cache of the values of the tag, filtered with tag_filter. The values are kept for ttl seconds and then
+    refreshed in the background while the cached values are used. If the refresh fail the last known good
+    values are used. The filter is compiled once and the filtered values are only recalculated when the values
+    from Tempo change.
+    A ttl of 0 fetch the values on every call.
+    The refresh use a fork of the client, with its own http session and counters, since it runs in another thread
+    than the collect. The counters of the fork are logged after every refresh.
+    """
+
+    def __init__(self, graph: str, client: TempoClient, tag: str, tag_filter: str = ".*", ttl: float = 0.0):
+        self.graph = graph
+        self._client = client.fork()
+        self.tag = tag
+        self.tag_filter = re.compile(tag_filter)
+        self.ttl = ttl
+        self._values: Optional[Tuple[str, ...]] = None
+        self._filtered: List[str] = []
+        self._fetched_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[List[str]]:
+        """
+        Get the filtered tag values
+        :return: the filtered values, None if the values never been fetched
+        """
+        with self._lock:
+            values = self._values
+            expired = time.monotonic() - self._fetched_at >= self.ttl
+            refresh_in_background = values is not None and expired and self.ttl > 0 and not self._refreshing
+            if refresh_in_background:
+                self._refreshing = True
+
+        if values is None or (expired and self.ttl <= 0):
+            self.refresh()
+        elif refresh_in_background:
+            threading.Thread(target=self.refresh, daemon=True).start()
+
+        with self._lock:
+            if self._values is None:
+                return None
+            return self._filtered
+
+    def refresh(self):
+        url_path = f"/search/tag/{self.tag}/values"
+        self._client.counters.reset()
+        try:
+            s_t = time.time()
+            response = self._client.get(url_path)
+            values = response.get('tagValues') if isinstance(response, dict) else None
+            if not isinstance(values, list):
+                log.warn_fmt({'graph': self.graph, 'url': url_path, 'cached': self._values is not None},
+                             "Invalid tag values response")
+                return
+            values = tuple(values)
+            log.info_fmt({'graph': self.graph, 'tag': self.tag, 'count': len(values),
+                          'response_time': (time.time() - s_t)}, "Search tags")
+            with self._lock:
+                if values != self._values:
+                    self._filtered = [value for value in values if self.tag_filter.search(value)]
+                    self._values = values
+                self._fetched_at = time.monotonic()
+        except (EmptyResponse, TempoCallFailed) as err:
+            log.warn_fmt({'graph': self.graph, 'url': url_path, 'error': err.__str__(),
+                          'cached': self._values is not None}, "Failed to refresh tag values")
+        except Exception as err:
+            log.error_fmt({'graph': self.graph, 'url': url_path, 'error': err.__str__(),
+                           'cached': self._values is not None}, "Failed to refresh tag values")
+        finally:
+            with self._lock:
+                self._refreshing = False
+            log_kv = {'graph': self.graph, 'url': url_path, 'circuit': self._client.breaker.state}
+            log_kv.update(self._client.counters.to_log())
+            log.info_fmt(log_kv, "Tempo client")
+
+
 class TempoTraces:
+    """
+    Collect the traces from Tempo and aggregate them to nodes and edges.
+    The aggregation state is bounded by max_spans, max_nodes and max_edges, 0 is no limit. When max_spans is
+    reached no more traces are fetched, span names of new nodes past max_nodes are collapsed into an "other" node
+    per service, service nodes are never collapsed, and only the max_edges edges with the highest count are kept.
+    The graph is then reported as partial.
+    """
+
     def __init__(self, graph: str, connection: RestConnection, tag: str, tag_filter: str = ".*",
                  use_tag_as_node: bool = True, service_node_sub_title: str = SERVICE_NODE_SUB_TITLE,
-                 trace_threshold_ms: float = 40.0):
+                 trace_threshold_ms: float = 40.0, client: TempoClient = None, shard: Shard = None,
+                 tag_values: TagValues = None, max_spans: int = 0, max_nodes: int = 0, max_edges: int = 0):
         self.graph = graph
         self._connection = connection
+        self._client = client if client else TempoClient(connection)
         self.tag = tag
         self.tag_filter = tag_filter
         self.use_tag_as_node = use_tag_as_node
         self.service_node_sub_title = service_node_sub_title
         self.trace_threshold_ms = trace_threshold_ms
+        self.shard = shard if shard else Shard()
+        self.tag_values = tag_values if tag_values else TagValues(graph, self._client, tag, tag_filter)
+        self.max_spans = max_spans
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
 
     def execute(self,
                 start_time: int = int(time.time() - TWO_HOURS),
                 end_time: int = int(time.time()),
                 search_mode: str = 'ingesters') -> Tuple[List[Node], List[Edge]]:
+        return self.collect(start_time=start_time, end_time=end_time,
+                            search_mode=search_mode).to_graph(self.trace_threshold_ms)
 
-        start = time.time()
-        log.info_fmt({'graph': self.graph, 'tag': self.tag}, "Search tags")
-        # Get all values for the selected tag, e.g. service.name
-        try:
-            all_service_tags = self._api_call(f"/search/tag/{self.tag}/values")
-        except EmptyResponse:
-            log.warn_fmt({'graph': self.graph, 'url': f"/search/tag/{self.tag}/values"}, f"{EMPTY_RESPONSE}")
-            return list(), list()
-
-        nodes: Dict[str, Node] = {}
-        span_to_node: Dict[str, Set[str]] = {}
-        node_span_parent: Dict[str, Set[str]] = {}
+    def collect(self,
+                start_time: int = int(time.time() - TWO_HOURS),
+                end_time: int = int(time.time()),
+                search_mode: str = 'ingesters') -> PartialGraph:
 
-        # Iterate over values of the tag and match against regular expression in tag_filter
+        start = time.time()
+        self._client.counters.reset()
+        partial = PartialGraph()
+        # Get all values for the selected tag, e.g. service.name, that match the regular expression in tag_filter
         # e.g. tag_filer = "cortex.*)
-        for tag_value in all_service_tags['tagValues']:
-            if not re.search(self.tag_filter, tag_value):
+        tag_values = self.tag_values.get()
+        if tag_values is None:
+            log.warn_fmt({'graph': self.graph, 'url': f"/search/tag/{self.tag}/values"}, f"{EMPTY_RESPONSE}")
+            self._log_client_counters()
+            return partial
+
+        # Every owned tag value can get a service node, the slots are reserved so service nodes are never collapsed
+        reserved_services = 0
+        if self.use_tag_as_node:
+            reserved_services = len([tag_value for tag_value in tag_values if self.shard.owns_tag_value(tag_value)])
+            if self.max_nodes and self.max_nodes <= reserved_services + 1:
+                log.warn_fmt({'graph': self.graph, 'max_nodes': self.max_nodes, 'service_nodes': reserved_services},
+                             "Node limit only fit the service nodes, all other nodes are collapsed")
+        buffer = SpanBuffer(max_nodes=self.max_nodes, reserved_services=reserved_services)
+
+        for tag_value in tag_values:
+            if DEGRADED_SPANS in partial.degraded:
+                break
+            if not self.shard.owns_tag_value(tag_value):
                 continue
             try:
                 s_t = time.time()
@@ -153,16 +469,9 @@ class TempoTraces:
             # high level node for the service
             if self.use_tag_as_node:
                 service_node_id = md5(str.encode(f"{tag_value}##service")).hexdigest()
-                if service_node_id not in nodes:
-                    service_node = Node()
-                    service_node.id = service_node_id
-                    service_node.title = tag_value
-                    service_node.subTitle = SERVICE_NODE_SUB_TITLE
-                    nodes[service_node_id] = service_node
-                    if service_node_id not in span_to_node:
-                        span_to_node[service_node_id] = set()
-                    span_to_node[service_node_id].add(service_node_id)
-                service_node = nodes[service_node_id]
+                service_node = buffer.node(tag_value, SERVICE_NODE_SUB_TITLE, service_node_id, service=True)
+                # The service node is the parent of the root spans
+                buffer.bind(service_node_id, service_node)
 
             # If the above search include traces
             if 'traces' in all_traces:
@@ -173,7 +482,14 @@ class TempoTraces:
                     # Only use traces where the rootTraceName is existing and set
                     # The rootTraceName is missing if the trace is not "completed" yet
                     # Typical the rootServiceName is set to '<root span not yet received>'
-                    if 'rootTraceName' in trace:
+                    if self.max_spans and len(buffer) >= self.max_spans:
+                        # Stop early, the spans already collected are used
+                        log.warn_fmt({'graph': self.graph, 'tag': self.tag, 'tag_value': tag_value,
+                                      'spans': len(buffer), 'max_spans': self.max_spans},
+                                     "Span limit reached, stop fetching traces")
+                        partial.degraded.add(DEGRADED_SPANS)
+                        break
+                    if 'rootTraceName' in trace and self.shard.owns_trace(trace['traceID']):
                         try:
                             s_t = time.time()
                             # Fetch the complete trace with the search_mode that define if the search should be done
@@ -209,92 +525,70 @@ class TempoTraces:
                             for spans in span_resources[span_key]:
                                 for span in spans['spans']:
                                     if 'name' in span:
-                                        # Get the span name and create an encoding of the combination of
-                                        # service and span name, e.g. 'cortex-ingester##/cortex.Ingester/Push'
-                                        # This is used as the Node identity
-                                        node_id = md5(str.encode(f"{service}##{span['name']}")).hexdigest()
-                                        if node_id not in nodes:
-                                            node = Node()
-                                            node.id = node_id
-                                            node.title = service
-                                            node.subTitle = span['name']
-                                            nodes[node_id] = node
-                                        node = nodes[node_id]
-                                        # Do stuff with metrics
-                                        node.mainStat += 1
-                                        node.secondaryStat += \
-                                            ((node.secondaryStat + float(span['endTimeUnixNano']) - float(
-                                                span['startTimeUnixNano']))
-                                             / node.mainStat) / 1000000
-                                        if node.secondaryStat > self.trace_threshold_ms:
-                                            node.arc__failed = 1.0
-                                            node.arc__passed = 0.0
-                                        else:
-                                            node.arc__failed = 0.0
-                                            node.arc__passed = 1.0
-
-                                        if self.use_tag_as_node:
-                                            service_node.mainStat += 1
-                                        # Keep track node id to parent span
-
-                                        if 'parentSpanId' in span:
-                                            if node_id not in node_span_parent:
-                                                node_span_parent[node_id] = set()
-                                            node_span_parent[node_id].add(span['parentSpanId'])
-                                        elif self.use_tag_as_node:
-                                            if node_id not in node_span_parent:
-                                                node_span_parent[node_id] = set()
-                                            node_span_parent[node_id].add(service_node_id)
-
-                                        if node_id not in span_to_node:
-                                            span_to_node[span['spanId']] = set()
-                                        span_to_node[span['spanId']].add(node_id)
-        # Create edges
-        edges: Dict[str, Edge] = {}
-        if nodes:
-            for node_id_taget, spans in node_span_parent.items():
-                for span_id in spans:
-                    if span_id in span_to_node:
-                        for node_id_source in span_to_node[span_id]:
-                            edge = Edge()
-                            edge.source = node_id_source
-                            edge.target = node_id_taget
-                            if f"{edge.source}#{edge.target}" not in edges:
-                                edges[f"{edge.source}#{edge.target}"] = edge
-                            edge = edges[f"{edge.source}#{edge.target}"]
-                            edge.mainStat += 1
-                    else:
-                        log.info_fmt(
-                            {'graph': self.graph, 'span_id': span_id},
-                            "Missing span id in node graph when creating edges")
+                                        # The combination of service and span name, e.g.
+                                        # 'cortex-ingester##/cortex.Ingester/Push' is the Node identity
+                                        node = buffer.node(service, span['name'])
+                                        # Keep track node to parent span
+                                        parent_span_id = span.get('parentSpanId')
+                                        if parent_span_id is None and self.use_tag_as_node:
+                                            parent_span_id = service_node_id
+                                        buffer.append(node, span['spanId'], parent_span_id,
+                                                      service_node if self.use_tag_as_node else NO_INDEX,
+                                                      int(span['startTimeUnixNano']), int(span['endTimeUnixNano']))
+                        # The spans are in the buffer, release the response before the next trace is fetched
+                        trace_spans = None
+
+        # Aggregate the spans and create edges
+        counts, durations, edges, missing = buffer.aggregate()
+        for node, node_id in enumerate(buffer.node_ids):
+            partial.add_node(node_id, buffer.titles[node], buffer.sub_titles[node], buffer.services[node])
+            partial.add_span(node_id, durations[node], counts[node])
+        for (source, target), count in edges.items():
+            partial.add_edge(buffer.node_ids[source], buffer.node_ids[target], count)
+        for span_id in missing:
+            log.info_fmt(
+                {'graph': self.graph, 'span_id': span_id},
+                "Missing span id in node graph when creating edges")
+        dropped_edges = partial.limit_edges(self.max_edges)
+        if buffer.collapsed:
+            partial.degraded.add(DEGRADED_NODES)
+        if self._client.counters.oversized:
+            partial.degraded.add(DEGRADED_RESPONSES)
 
         log.info_fmt(
-            {'graph': self.graph, 'nodes': len(nodes.values()), 'edges': len(edges.values()),
-             'time': time.time() - start},
+            {'graph': self.graph, 'shard': self.shard.index, 'spans': len(buffer), 'nodes': len(partial.nodes),
+             'edges': len(partial.edges), 'time': time.time() - start},
             "Read traces from tempo")
+        self._log_client_counters()
+        if partial.degraded:
+            log.warn_fmt(
+                {'graph': self.graph, 'shard': self.shard.index, 'degraded': ','.join(sorted(partial.degraded)),
+                 'spans': len(buffer), 'collapsed_spans': buffer.collapsed, 'dropped_edges': dropped_edges,
+                 'oversized_responses': self._client.counters.oversized},
+                "Limits reached, graph is partial")
 
-        if nodes and edges:
-            return list(nodes.values()), list(edges.values())
-        else:
-            return list(), list()
+        return partial
 
     def _api_call(self, url_path: str) -> Dict[str, Any]:
         try:
-            r = requests.get(url=f"{self._connection.url}{url_path}", headers=self._connection.headers,
-                             timeout=self._connection.timeout)
-
-            if r.status_code == 200:
-                response = r.json()
-                if response:
-                    return response
-            else:
-                log.error_fmt({'graph': self.graph, 'tag': self.tag, 'url': url_path, 'status': r.status_code},
+            return self._client.get(url_path)
+        except CircuitOpen:
+            # Shed calls are summarized in the cycle counters
+            log.debug_fmt({'graph': self.graph, 'tag': self.tag, 'url': url_path}, "Circuit breaker open")
+        except TempoCallFailed as err:
+            if err.status:
+                log.error_fmt({'graph': self.graph, 'tag': self.tag, 'url': url_path, 'status': err.status},
                               "Not a expected response")
-        except Exception as err:
-            log.error_fmt({'graph': self.graph, 'tag': self.tag, 'url': url_path, 'error': err.__str__()},
-                          "Connection to tempo failed")
+            else:
+                log.error_fmt({'graph': self.graph, 'tag': self.tag, 'url': url_path, 'error': err.reason},
+                              "Connection to tempo failed")
         raise EmptyResponse()
 
+    def _log_client_counters(self):
+        log_kv = {'graph': self.graph, 'circuit': self._client.breaker.state}
+        log_kv.update(self._client.counters.to_log())
+        log.info_fmt(log_kv, "Tempo client")
+
 
 class NodeGraphAPI:
     def __init__(self, graph: str, connection: RestConnection):
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2022  Anders Håål and Redbridge AB
+
+    This file is part of tta - Tempo trace aggregation.
+
+    indis is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    indis is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tta.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Tuple
+
+import requests
+
+from tempo_trace_aggregation.collect import PartialGraph, Shard, Node, Edge
+from tempo_trace_aggregation.logging import Log
+
+log = Log(__name__)
+
+
+def envelope(graph: str, shard: Shard, partial: PartialGraph) -> Dict[str, Any]:
+    data = partial.to_dict()
+    data.update({'graph': graph, 'shard': shard.index, 'shard_count': shard.count, 'by': shard.by,
+                 'created': time.time()})
+    return data
+
+
+def validate_envelope(data: Any, shard: Shard):
+    """
+    Validate a partial received from a shard, the envelope and the nodes and edges
+    :raise ValueError: if the partial is not valid
+    """
+    PartialGraph.validate(data)
+    if not isinstance(data.get('graph'), str):
+        raise ValueError("Partial graph must be a string")
+    index = data.get('shard')
+    if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index < shard.count:
+        raise ValueError(f"Partial shard {index} is not in the range of shard count {shard.count}")
+    if not isinstance(data.get('shard_count'), int) or not isinstance(data.get('created'), (int, float)):
+        raise ValueError("Partial shard_count and created must be numbers")
+
+
+class DirectoryExchange:
+    """
+    Exchange partials through a directory shared by all the tta instances on the same host.
+    Every shard write its latest partial to <directory>/<graph>-shard-<index>.json
+    """
+
+    def __init__(self, graph: str, shard: Shard, directory: str):
+        self.graph = graph
+        self.shard = shard
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _file_name(self, index: int) -> str:
+        return os.path.join(self.directory, f"{self.graph}-shard-{index}.json")
+
+    def publish(self, partial: PartialGraph):
+        file_name = self._file_name(self.shard.index)
+        tmp_file_name = f"{file_name}.tmp"
+        try:
+            with open(tmp_file_name, 'w') as stream:
+                json.dump(envelope(self.graph, self.shard, partial), stream)
+            # Atomic so the merger never read a partial written file
+            os.replace(tmp_file_name, file_name)
+        except OSError as err:
+            log.error_fmt({'graph': self.graph, 'shard': self.shard.index, 'file': file_name,
+                           'error': err.__str__()}, "Failed to publish partial")
+
+    def partials(self) -> List[Dict[str, Any]]:
+        partials = []
+        for index in range(self.shard.count):
+            file_name = self._file_name(index)
+            if not os.path.exists(file_name):
+                continue
+            try:
+                with open(file_name, 'r') as stream:
+                    data = json.load(stream)
+                validate_envelope(data, self.shard)
+                partials.append(data)
+            except (OSError, ValueError) as err:
+                log.warn_fmt({'graph': self.graph, 'shard': index, 'file': file_name, 'error': err.__str__()},
+                             "Failed to read partial")
+        return partials
+
+
+class HttpExchange:
+    """
+    Exchange partials by posting them to the merger instance. The merger run a http server on listen,
+    e.g. 0.0.0.0:9494, and the other shards post to merger_url, e.g. http://localhost:9494
+    """
+
+    def __init__(self, graph: str, shard: Shard, merger_url: str = '', listen: str = '', timeout: int = 15):
+        self.graph = graph
+        self.shard = shard
+        self.merger_url = merger_url
+        self.timeout = timeout
+        self._partials: Dict[int, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._server = None
+        if not listen and not merger_url:
+            raise ValueError("A http exchange must have listen for the merger or merger_url for the other shards")
+        if listen:
+            self._serve(listen)
+
+    def _serve(self, listen: str):
+        exchange = self
+        host, port = listen.rsplit(':', 1)
+
+        class PartialHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    exchange.store(json.loads(self.rfile.read(length)))
+                    self.send_response(201)
+                except (ValueError, KeyError, TypeError) as err:
+                    log.warn_fmt({'graph': exchange.graph, 'error': err.__str__()}, "Invalid partial received")
+                    self.send_response(400)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, int(port)), PartialHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        log.info_fmt({'graph': self.graph, 'listen': listen}, "Merger listening for partials")
+
+    def store(self, data: Dict[str, Any]):
+        """
+        :raise ValueError: if the partial is not valid
+        """
+        validate_envelope(data, self.shard)
+        with self._lock:
+            self._partials[int(data['shard'])] = data
+
+    def publish(self, partial: PartialGraph):
+        data = envelope(self.graph, self.shard, partial)
+        if self._server:
+            # This instance is the merger
+            self.store(data)
+            return
+        try:
+            r = requests.post(self.merger_url, data=json.dumps(data),
+                              headers={'content-type': 'application/json'}, timeout=self.timeout)
+            if r.status_code != 201:
+                log.warn_fmt({'graph': self.graph, 'shard': self.shard.index, 'url': self.merger_url,
+                              'status_code': r.status_code}, "Failed to publish partial")
+        except Exception as err:
+            log.error_fmt({'graph': self.graph, 'shard': self.shard.index, 'url': self.merger_url,
+                           'error': err.__str__()}, "Connection to merger failed")
+
+    def partials(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._partials.values())
+
+
+class Merger:
+    """
+    Combine the partials of all shards to one graph. The merger wait up to wait seconds for all shards to
+    have published a partial not older than max_age seconds. Shards that are missing after the wait are
+    logged and the graph is created from the partials that exist.
+    The merged graph is limited to max_nodes nodes and the max_edges edges with the highest count, 0 is no limit,
+    since every shard apply the limits to its own partial and the union can be up to shard count times larger.
+    """
+
+    def __init__(self, graph: str, shard: Shard, exchange, trace_threshold_ms: float = 40.0,
+                 max_age: float = 120.0, wait: float = 30.0, max_nodes: int = 0, max_edges: int = 0):
+        self.graph = graph
+        self.shard = shard
+        self.exchange = exchange
+        self.trace_threshold_ms = trace_threshold_ms
+        self.max_age = max_age
+        self.wait = wait
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
+
+    def _fresh(self) -> Dict[int, Dict[str, Any]]:
+        fresh = {}
+        for data in self.exchange.partials():
+            if data.get('graph') != self.graph or data.get('shard_count') != self.shard.count:
+                continue
+            if time.time() - data.get('created', 0) <= self.max_age:
+                fresh[int(data['shard'])] = data
+        return fresh
+
+    def merge(self) -> Tuple[List[Node], List[Edge]]:
+        start = time.time()
+        fresh = self._fresh()
+        while len(fresh) < self.shard.count and time.time() - start < self.wait:
+            time.sleep(0.5)
+            fresh = self._fresh()
+
+        merged = PartialGraph()
+        invalid = []
+        for index, data in sorted(fresh.items()):
+            try:
+                # Validate before the merge so a bad partial is never half merged
+                PartialGraph.validate(data)
+                merged.merge(PartialGraph.from_dict(data))
+            except (ValueError, KeyError, TypeError) as err:
+                log.error_fmt({'graph': self.graph, 'shard': index, 'error': err.__str__()},
+                              "Invalid partial, shard is skipped")
+                invalid.append(index)
+        collapsed_nodes = merged.limit_nodes(self.max_nodes)
+        dropped_edges = merged.limit_edges(self.max_edges)
+
+        missing = [index for index in range(self.shard.count) if index not in fresh or index in invalid]
+        log_kv = {'graph': self.graph, 'shards': len(fresh) - len(invalid), 'shard_count': self.shard.count,
+                  'nodes': len(merged.nodes), 'edges': len(merged.edges), 'time': time.time() - start}
+        if merged.degraded:
+            log_kv['degraded'] = ','.join(sorted(merged.degraded))
+        if collapsed_nodes:
+            log_kv['collapsed_nodes'] = collapsed_nodes
+        if dropped_edges:
+            log_kv['dropped_edges'] = dropped_edges
+        if missing:
+            log_kv['missing'] = ','.join(str(index) for index in missing)
+        if missing or merged.degraded:
+            log.warn_fmt(log_kv, "Merge shards, graph is partial")
+        else:
+            log.info_fmt(log_kv, "Merge shards")
+
+        return merged.to_graph(self.trace_threshold_ms)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2022  Anders Håål and Redbridge AB
+
+    This file is part of tta - Tempo trace aggregation.
+
+    indis is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    indis is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tta.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from array import array
+from hashlib import md5
+from typing import List, Dict, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NO_INDEX = -1
+OTHER_SUB_TITLE = 'other'
+OTHER_TITLE = 'other'
+
+
+class SpanBuffer:
+    """
+    Columnar buffer of the spans of a collect. Node ids and span ids are interned to int indexes and every span
+    is appended as a row of node, parent span, service node, start and end time. The aggregation of counts,
+    durations and edges is done over the columns, with numpy if installed, else with plain python.
+    The number of nodes is bounded by max_nodes, 0 is no limit. Service nodes are never collapsed and reserved_services
+    slots are kept for them. Every title also reserve a slot for its "other" node when its first node is created,
+    and one slot is reserved for a global "other" node, used for titles that are first seen when the buffer is full.
+    A new node that does not fit is collapsed into the "other" node of its title.
+    """
+
+    def __init__(self, use_numpy: bool = True, max_nodes: int = 0, reserved_services: int = 0):
+        self.use_numpy = use_numpy and np is not None
+        self.max_nodes = max_nodes
+        # Number of node lookups collapsed into an other node
+        self.collapsed = 0
+        self._service_reserve = reserved_services
+        # Titles with a reserved slot for the other node, and the titles that can collapse into their own other node
+        self._other_reserve: Set[str] = set()
+        self._titles: Set[str] = set()
+        self._global_other = False
+        # Interned nodes, the index is the position in the lists
+        self.node_ids: List[str] = []
+        self.titles: List[str] = []
+        self.sub_titles: List[str] = []
+        self.services: List[bool] = []
+        # Nodes are interned by the node id, the derived ids are memoized by title and sub title
+        self._node_index: Dict[str, int] = {}
+        self._derived_index: Dict[Tuple[str, str], int] = {}
+        # Interned span ids and the node of the span, NO_INDEX if the span is only known as a parent
+        self._span_index: Dict[str, int] = {}
+        self._span_node = array('q')
+        # Span columns
+        self._node = array('q')
+        self._parent = array('q')
+        self._service = array('q')
+        self._start = array('q')
+        self._end = array('q')
+
+    def __len__(self):
+        return len(self._node)
+
+    def node(self, title: str, sub_title: str, node_id: str = None, service: bool = False) -> int:
+        """
+        Get the index of the node, the node is created if not existing
+        :param title: the node title, e.g. the service name
+        :param sub_title: the node sub title, e.g. the span name
+        :param node_id: the node id, default the md5 of title##sub_title
+        :param service: True for a service node, a service node is never collapsed
+        :return: the node index
+        """
+        if node_id is not None:
+            index = self._node_index.get(node_id)
+            if index is None:
+                if service and self._service_reserve > 0:
+                    self._service_reserve -= 1
+                index = self._create(node_id, title, sub_title, service)
+            return index
+
+        index = self._derived_index.get((title, sub_title))
+        if index is not None:
+            return index
+        node_id = md5(str.encode(f"{title}##{sub_title}")).hexdigest()
+        index = self._node_index.get(node_id)
+        if index is None:
+            new_title = title not in self._titles
+            if self.max_nodes and self._reserved() + 1 + new_title > self.max_nodes:
+                # Not memoized, a new node is collapsed on every lookup
+                self.collapsed += 1
+                return self._other(title)
+            if new_title:
+                self._titles.add(title)
+                self._other_reserve.add(title)
+            index = self._create(node_id, title, sub_title, service)
+        self._derived_index[(title, sub_title)] = index
+        return index
+
+    def _reserved(self) -> int:
+        """
+        The number of nodes plus the slots reserved for service and other nodes
+        """
+        return len(self.node_ids) + self._service_reserve + len(self._other_reserve) + (not self._global_other)
+
+    def _other(self, title: str) -> int:
+        if title in self._titles:
+            self._other_reserve.discard(title)
+        else:
+            title = OTHER_TITLE
+            self._global_other = True
+        other_id = md5(str.encode(f"{title}##{OTHER_SUB_TITLE}")).hexdigest()
+        index = self._node_index.get(other_id)
+        if index is None:
+            index = self._create(other_id, title, OTHER_SUB_TITLE, False)
+        return index
+
+    def _create(self, node_id: str, title: str, sub_title: str, service: bool) -> int:
+        index = len(self.node_ids)
+        self._node_index[node_id] = index
+        self.node_ids.append(node_id)
+        self.titles.append(title)
+        self.sub_titles.append(sub_title)
+        self.services.append(service)
+        return index
+
+    def span(self, span_id: str) -> int:
+        index = self._span_index.get(span_id)
+        if index is None:
+            index = len(self._span_node)
+            self._span_index[span_id] = index
+            self._span_node.append(NO_INDEX)
+        return index
+
+    def bind(self, span_id: str, node: int):
+        """
+        Make span_id resolve to node when edges are created, e.g. for the service node as a parent
+        """
+        self._span_node[self.span(span_id)] = node
+
+    def append(self, node: int, span_id: str, parent_span_id: str = None, service: int = NO_INDEX,
+               start: int = 0, end: int = 0):
+        self.bind(span_id, node)
+        self._node.append(node)
+        self._parent.append(self.span(parent_span_id) if parent_span_id is not None else NO_INDEX)
+        self._service.append(service)
+        self._start.append(start)
+        self._end.append(end)
+
+    def aggregate(self) -> Tuple[List[int], List[float], Dict[Tuple[int, int], int], List[str]]:
+        """
+        Aggregate the spans
+        :return: count and duration in ms per node index, the edge count per (source, target) node index and the
+        parent span ids that are not in the buffer
+        """
+        if self.use_numpy:
+            return self._aggregate_numpy()
+        return self._aggregate_python()
+
+    def _missing_span_ids(self, indexes) -> List[str]:
+        if not len(indexes):
+            return []
+        span_ids = list(self._span_index.keys())
+        return [span_ids[index] for index in indexes]
+
+    def _aggregate_python(self):
+        nodes = len(self.node_ids)
+        counts = [0] * nodes
+        durations = [0.0] * nodes
+        for node, service, start, end in zip(self._node, self._service, self._start, self._end):
+            counts[node] += 1
+            durations[node] += (end - start) / 1000000
+            if service != NO_INDEX:
+                counts[service] += 1
+
+        # An edge is counted once for every distinct parent span of the target node
+        edges: Dict[Tuple[int, int], int] = {}
+        missing = set()
+        for parent, target in set(zip(self._parent, self._node)):
+            if parent == NO_INDEX:
+                continue
+            source = self._span_node[parent]
+            if source == NO_INDEX:
+                missing.add(parent)
+                continue
+            edges[(source, target)] = edges.get((source, target), 0) + 1
+        return counts, durations, edges, self._missing_span_ids(sorted(missing))
+
+    def _aggregate_numpy(self):
+        nodes = len(self.node_ids)
+        node = np.frombuffer(self._node, dtype=np.int64)
+        parent = np.frombuffer(self._parent, dtype=np.int64)
+        service = np.frombuffer(self._service, dtype=np.int64)
+        span_node = np.frombuffer(self._span_node, dtype=np.int64)
+
+        counts = np.bincount(node, minlength=nodes)
+        service = service[service != NO_INDEX]
+        if len(service):
+            counts = counts + np.bincount(service, minlength=nodes)
+        duration_ns = np.frombuffer(self._end, dtype=np.int64) - np.frombuffer(self._start, dtype=np.int64)
+        durations = np.bincount(node, weights=duration_ns.astype(np.float64), minlength=nodes) / 1000000
+
+        # Distinct (parent span, target node) pairs, group by the sorted keys
+        has_parent = parent != NO_INDEX
+        pairs = np.unique(parent[has_parent] * nodes + node[has_parent])
+        parent = pairs // nodes
+        target = pairs % nodes
+        source = span_node[parent]
+        known = source != NO_INDEX
+        keys, edge_counts = np.unique(source[known] * nodes + target[known], return_counts=True)
+        edges = {(int(key // nodes), int(key % nodes)): int(count) for key, count in zip(keys, edge_counts)}
+        return counts.tolist(), durations.tolist(), edges, self._missing_span_ids(np.unique(parent[~known]).tolist())
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2022  Anders Håål and Redbridge AB
+
+    This file is part of tta - Tempo trace aggregation.
+
+    indis is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    indis is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tta.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from tempo_trace_aggregation.client import TempoClient, TokenBucket, EmptyResponse, TempoCallFailed, CircuitOpen, \
+    CIRCUIT_CLOSED, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN
+from tempo_trace_aggregation import collect
+from tempo_trace_aggregation.collect import RestConnection, TagValues
+
+OK = ('json', {'tagValues': ['frontend']})
+DROP = ('drop',)
+BROKEN = ('broken',)
+
+
+def status(code: int, headers: dict = None):
+    return 'status', code, headers or {}
+
+
+class FakeTempo:
+    """
+    A local http server that answer every request with the next action in the script, 200 if the script is empty
+    """
+
+    def __init__(self):
+        self.script = []
+        self.requests = 0
+        # Called with the request path when a request is received
+        self.on_request = None
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fake.requests += 1
+                if fake.on_request:
+                    fake.on_request(self.path)
+                action = fake.script.pop(0) if fake.script else OK
+                if action[0] == 'drop':
+                    # Close the connection without any response
+                    self.close_connection = True
+                    return
+                if action[0] == 'broken':
+                    self.send_response(200)
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    self.wfile.write(b"zz\r\nnot a chunk\r\n")
+                    self.close_connection = True
+                    return
+                if action[0] == 'status':
+                    self.send_response(action[1])
+                    for key, value in action[2].items():
+                        self.send_header(key, value)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = json.dumps(action[1]).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+
+@pytest.fixture
+def tempo():
+    fake = FakeTempo()
+    yield fake
+    fake.server.shutdown()
+    fake.server.server_close()
+
+
+def client_for(tempo: FakeTempo, **kwargs) -> TempoClient:
+    connection = RestConnection()
+    connection.url = tempo.url
+    connection.timeout = 2
+    kwargs.setdefault('backoff', 0.01)
+    kwargs.setdefault('backoff_max', 2.0)
+    return TempoClient(connection, **kwargs)
+
+
+def test_retry_on_429_with_retry_after_and_503(tempo):
+    tempo.script = [status(429, {'Retry-After': '1'}), status(503), OK]
+    client = client_for(tempo, retries=3)
+
+    start = time.monotonic()
+    assert client.get('/search/tag/service.name/values') == OK[1]
+    assert time.monotonic() - start >= 1.0
+
+    assert client.counters.requests == 3
+    assert client.counters.retries == 2
+    assert client.counters.throttled == 1
+    assert client.counters.failed == 0
+    assert client.breaker.state == CIRCUIT_CLOSED
+
+
+def test_retry_after_longer_than_backoff_max_is_not_retried(tempo):
+    tempo.script = [status(429, {'Retry-After': '60'})]
+    client = client_for(tempo, retries=3, backoff_max=2.0)
+
+    start = time.monotonic()
+    with pytest.raises(TempoCallFailed) as err:
+        client.get('/traces/1')
+    assert time.monotonic() - start < 1.0
+    assert err.value.status == 429
+    assert err.value.unhealthy
+
+    assert tempo.requests == 1
+    assert client.counters.retries == 0
+    assert client.counters.throttled == 1
+    assert client.counters.failed == 1
+
+
+def test_dropped_connections_fail_after_retries(tempo):
+    tempo.script = [DROP, DROP, DROP]
+    client = client_for(tempo, retries=2)
+
+    with pytest.raises(TempoCallFailed) as err:
+        client.get('/traces/1')
+    assert err.value.unhealthy
+
+    assert client.counters.requests == 3
+    assert client.counters.retries == 2
+    assert client.counters.failed == 1
+    assert client.counters.to_log()['dropped'] == 1
+
+
+def test_404_is_empty_and_not_retried(tempo):
+    tempo.script = [status(404)]
+    client = client_for(tempo, retries=3, circuit_failures=1)
+
+    with pytest.raises(EmptyResponse):
+        client.get('/traces/1')
+
+    assert client.counters.requests == 1
+    assert client.counters.retries == 0
+    assert client.counters.failed == 0
+    assert client.breaker.state == CIRCUIT_CLOSED
+
+
+def test_breaker_open_half_open_closed(tempo):
+    tempo.script = [status(503), status(503), status(503), status(503)]
+    client = client_for(tempo, retries=1, circuit_failures=2, circuit_reset=0.2)
+
+    # The breaker count failed calls, not attempts
+    with pytest.raises(TempoCallFailed):
+        client.get('/traces/1')
+    assert client.breaker.state == CIRCUIT_CLOSED
+    with pytest.raises(TempoCallFailed):
+        client.get('/traces/2')
+    assert client.breaker.state == CIRCUIT_OPEN
+    assert tempo.requests == 4
+
+    # Shed without any request to tempo
+    with pytest.raises(CircuitOpen):
+        client.get('/traces/3')
+    assert tempo.requests == 4
+    assert client.counters.shed == 1
+
+    states = []
+    tempo.on_request = lambda path: states.append(client.breaker.state)
+    time.sleep(0.25)
+    assert client.get('/traces/4') == OK[1]
+    assert states == [CIRCUIT_HALF_OPEN]
+    assert client.breaker.state == CIRCUIT_CLOSED
+
+
+def test_half_open_trial_completed_on_broken_response(tempo):
+    tempo.script = [status(503), BROKEN]
+    client = client_for(tempo, retries=0, circuit_failures=1, circuit_reset=0.1)
+
+    with pytest.raises(TempoCallFailed):
+        client.get('/traces/1')
+    assert client.breaker.state == CIRCUIT_OPEN
+
+    time.sleep(0.15)
+    # The trial fail on a broken chunked response, that must open the breaker again and not block it
+    with pytest.raises(TempoCallFailed) as err:
+        client.get('/traces/2')
+    assert err.value.unhealthy
+    assert client.breaker.state == CIRCUIT_OPEN
+
+    time.sleep(0.15)
+    assert client.get('/traces/3') == OK[1]
+    assert client.breaker.state == CIRCUIT_CLOSED
+
+
+def test_token_bucket_pacing():
+    bucket = TokenBucket(rate=20.0, burst=2)
+
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    elapsed = time.monotonic() - start
+
+    # Two tokens from the burst and then one token every 1/20 sec
+    assert 0.18 <= elapsed < 0.5
+
+
+def test_client_rate_limit(tempo):
+    client = client_for(tempo, rate_limit=10.0, rate_burst=1)
+
+    start = time.monotonic()
+    for _ in range(4):
+        client.get('/search/tag/service.name/values')
+
+    assert time.monotonic() - start >= 0.29
+    # The time of the requests is part of the refill, so the wait is a bit less than 3 * 0.1 sec
+    assert client.counters.rate_limit_wait >= 0.2
+    assert tempo.requests == 4
+
+
+def test_tag_values_refresh_log_counters(tempo, monkeypatch):
+    logged = []
+    monkeypatch.setattr(collect.log, 'info_fmt', lambda log_kv, message=None: logged.append((log_kv, message)))
+    tempo.script = [status(503), OK]
+    tag_values = TagValues('g', client_for(tempo, retries=3), 'service.name')
+
+    assert tag_values.get() == ['frontend']
+    counters = [log_kv for log_kv, message in logged if message == "Tempo client"]
+    assert len(counters) == 1
+    assert counters[0]['url'] == '/search/tag/service.name/values'
+    assert counters[0]['requests'] == 2
+    assert counters[0]['retries'] == 1
+
+    # The counters are reset for every refresh
+    tag_values.refresh()
+    counters = [log_kv for log_kv, message in logged if message == "Tempo client"]
+    assert counters[1]['requests'] == 1
+    assert counters[1]['retries'] == 0
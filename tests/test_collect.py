@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2022  Anders Håål and Redbridge AB
+
+    This file is part of tta - Tempo trace aggregation.
+
+    indis is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    indis is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tta.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from hashlib import md5
+from typing import Dict, List, Tuple
+
+from tempo_trace_aggregation.client import CallCounters, CircuitBreaker
+from tempo_trace_aggregation.collect import TempoTraces, RestConnection, PartialGraph, DEGRADED_NODES, DEGRADED_SPANS, \
+    DEGRADED_EDGES
+from tempo_trace_aggregation.spans import OTHER_TITLE, OTHER_SUB_TITLE
+
+
+class FakeClient:
+    """
+    Answer the tempo calls from traces, trace id -> list of (service, span)
+    """
+
+    def __init__(self, traces: Dict[str, List[Tuple[str, dict]]]):
+        self.traces = traces
+        self.counters = CallCounters()
+        self.breaker = CircuitBreaker()
+
+    def fork(self) -> 'FakeClient':
+        return self
+
+    def services(self) -> List[str]:
+        return sorted({service for spans in self.traces.values() for service, _ in spans})
+
+    def get(self, url_path: str) -> dict:
+        if url_path.startswith('/search/tag/'):
+            return {'tagValues': self.services()}
+        if url_path.startswith('/search?'):
+            tag_value = url_path.split('%3D')[1].split('&')[0]
+            return {'traces': [{'traceID': trace_id, 'rootTraceName': 'root'}
+                               for trace_id, spans in self.traces.items() if spans[0][0] == tag_value]}
+        trace_id = url_path.split('/')[2].split('?')[0]
+        batches: Dict[str, List[dict]] = {}
+        for service, span in self.traces[trace_id]:
+            batches.setdefault(service, []).append(span)
+        return {'batches': [{'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service}}]},
+                             'scopeSpans': [{'spans': spans}]} for service, spans in batches.items()]}
+
+
+def span(span_id: str, name: str, parent_span_id: str = None, duration_ms: int = 1) -> dict:
+    data = {'spanId': span_id, 'name': name, 'startTimeUnixNano': '0',
+            'endTimeUnixNano': str(duration_ms * 1000000)}
+    if parent_span_id:
+        data['parentSpanId'] = parent_span_id
+    return data
+
+
+def traces_for(client: FakeClient, **kwargs) -> TempoTraces:
+    return TempoTraces('g', RestConnection(), 'service.name', '.*', True, 'Service Node', 40.0, client=client,
+                       **kwargs)
+
+
+def node_id(title: str, sub_title: str) -> str:
+    return md5(str.encode(f"{title}##{sub_title}")).hexdigest()
+
+
+def test_span_named_service_node_is_not_merged_into_the_service_node():
+    client = FakeClient({
+        't1': [('frontend', span('a', 'Service Node')), ('api', span('b', 'query', 'a'))],
+        't2': [('frontend', span('c', 'Service Node')), ('api', span('d', 'query', 'c'))],
+    })
+
+    partial = traces_for(client).collect()
+
+    service_node = partial.nodes[node_id('frontend', 'service')]
+    span_node = partial.nodes[node_id('frontend', 'Service Node')]
+    assert service_node['service'] and not span_node['service']
+    # The service node count all spans of the traces searched for the service, the span node only its own spans
+    assert service_node['count'] == 4
+    assert span_node['count'] == 2
+    # An edge from a service node is counted once
+    edge = f"{node_id('frontend', 'service')}#{node_id('frontend', 'Service Node')}"
+    assert partial.edges[edge]['count'] == 1
+    edge = f"{node_id('frontend', 'Service Node')}#{node_id('api', 'query')}"
+    assert partial.edges[edge]['count'] == 2
+
+
+def test_limit_nodes_keep_service_nodes_and_the_limit():
+    partial = PartialGraph()
+    for service in ('frontend', 'api', 'db'):
+        partial.add_node(node_id(service, 'service'), service, 'Service Node', service=True)
+        partial.add_span(node_id(service, 'service'), 0.0, 100)
+        for index in range(5):
+            partial.add_node(node_id(service, f"span-{index}"), service, f"span-{index}")
+            partial.add_span(node_id(service, f"span-{index}"), 1.0 * index, index + 1)
+            partial.add_edge(node_id(service, 'service'), node_id(service, f"span-{index}"))
+
+    collapsed = partial.limit_nodes(7)
+
+    assert len(partial.nodes) <= 7
+    assert collapsed > 0
+    assert DEGRADED_NODES in partial.degraded
+    assert sum(node['service'] for node in partial.nodes.values()) == 3
+    # Nothing is lost, the counts are moved to the other nodes
+    assert sum(node['count'] for node in partial.nodes.values()) == 3 * 100 + 3 * 15
+    assert all(edge['source'] in partial.nodes and edge['target'] in partial.nodes
+               for edge in partial.edges.values())
+    # A kept title collapse into its own other node, a title without any kept node into the global other node
+    titles = {node['title'] for node in partial.nodes.values() if not node['service']}
+    assert node_id(OTHER_TITLE, OTHER_SUB_TITLE) in partial.nodes
+    for title in titles - {OTHER_TITLE}:
+        assert node_id(title, OTHER_SUB_TITLE) in partial.nodes
+
+
+def test_limit_nodes_below_the_limit_is_unchanged():
+    partial = PartialGraph()
+    partial.add_node('a', 'api', 'query')
+    partial.add_span('a', 1.0)
+
+    assert partial.limit_nodes(2) == 0
+    assert list(partial.nodes) == ['a']
+    assert not partial.degraded
+
+
+def many_traces(count: int = 20) -> Dict[str, List[Tuple[str, dict]]]:
+    traces = {}
+    for trace in range(count):
+        root = span(f"{trace}-0", 'GET /')
+        traces[f"t{trace}"] = [('frontend', root)] + [
+            (service, span(f"{trace}-{index}", f"{service}-{index % 4}-{trace % 3}", root['spanId']))
+            for index, service in enumerate(['api', 'db', 'cache', 'api', 'db'], start=1)]
+    return traces
+
+
+def test_no_limits_is_not_degraded():
+    partial = traces_for(FakeClient(many_traces())).collect()
+
+    assert not partial.degraded
+    # A service node for every tag value
+    assert sum(node['service'] for node in partial.nodes.values()) == 4
+
+
+def test_max_spans_stop_early():
+    client = FakeClient(many_traces())
+
+    partial = traces_for(client, max_spans=30).collect()
+
+    assert partial.degraded == {DEGRADED_SPANS}
+    # Stop at the first trace after the limit, a trace has 6 spans
+    span_nodes = [node for node in partial.nodes.values() if not node['service']]
+    assert sum(node['count'] for node in span_nodes) == 30
+
+
+def test_max_nodes_degraded():
+    unlimited = traces_for(FakeClient(many_traces())).collect()
+    partial = traces_for(FakeClient(many_traces()), max_nodes=10).collect()
+
+    assert len(unlimited.nodes) > 10
+    assert partial.degraded == {DEGRADED_NODES}
+    assert len(partial.nodes) <= 10
+    assert sum(node['service'] for node in partial.nodes.values()) == 4
+    assert sum(node['count'] for node in partial.nodes.values()) == \
+        sum(node['count'] for node in unlimited.nodes.values())
+
+
+def test_max_edges_degraded():
+    unlimited = traces_for(FakeClient(many_traces())).collect()
+    partial = traces_for(FakeClient(many_traces()), max_edges=5).collect()
+
+    assert partial.degraded == {DEGRADED_EDGES}
+    assert len(partial.edges) == 5
+    counts = sorted((edge['count'] for edge in unlimited.edges.values()), reverse=True)
+    assert sorted((edge['count'] for edge in partial.edges.values()), reverse=True) == counts[:5]
+
+
+def test_limit_edges():
+    partial = PartialGraph()
+    for index in range(4):
+        partial.add_node(f"n{index}", 'api', f"n{index}")
+    for index, count in enumerate([5, 1, 3]):
+        partial.add_edge('n0', f"n{index + 1}", count)
+
+    assert partial.limit_edges(0) == 0
+    assert partial.limit_edges(3) == 0
+    assert not partial.degraded
+    assert partial.limit_edges(2) == 1
+    assert sorted(edge['count'] for edge in partial.edges.values()) == [3, 5]
+    assert partial.degraded == {DEGRADED_EDGES}
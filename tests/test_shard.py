@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2022  Anders Håål and Redbridge AB
+
+    This file is part of tta - Tempo trace aggregation.
+
+    indis is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    indis is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tta.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import json
+import os
+import socket
+import time
+
+import pytest
+import requests
+
+from tempo_trace_aggregation.collect import PartialGraph, Shard, SHARD_BY_TRACE_ID
+from tempo_trace_aggregation.shard import DirectoryExchange, HttpExchange, Merger, envelope
+
+
+def partial_of(node_id: str, title: str, count: int) -> PartialGraph:
+    partial = PartialGraph()
+    partial.add_node(node_id, title, 'GET /')
+    partial.add_span(node_id, 10.0 * count, count)
+    partial.add_node('root', 'frontend', 'root')
+    partial.add_span('root', 1.0)
+    partial.add_edge('root', node_id)
+    return partial
+
+
+def invalid_envelope(shard: int) -> dict:
+    return {'graph': 'g', 'shard': shard, 'shard_count': 2, 'created': time.time(), 'nodes': {'x': {}}}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class StaticExchange:
+    def __init__(self, partials):
+        self._partials = partials
+
+    def partials(self):
+        return self._partials
+
+
+def test_validate_partial():
+    PartialGraph.validate(partial_of('a', 'api', 2).to_dict())
+    for data in ([], {'nodes': []}, {'nodes': {'x': {}}},
+                 {'nodes': {'x': {'title': 'a', 'subTitle': 'b', 'count': '1', 'duration_ms': 1.0}}},
+                 {'edges': {'x#y': {'source': 'x', 'target': 'y'}}}, {'degraded': 'nodes'}):
+        with pytest.raises(ValueError):
+            PartialGraph.validate(data)
+
+
+def test_http_exchange_reject_invalid_partial():
+    shard = Shard(0, 2, SHARD_BY_TRACE_ID)
+    listen = f"127.0.0.1:{free_port()}"
+    exchange = HttpExchange('g', shard, listen=listen)
+    url = f"http://{listen}"
+
+    assert requests.post(url, data=json.dumps(invalid_envelope(1))).status_code == 400
+    assert requests.post(url, data=json.dumps([1, 2])).status_code == 400
+    assert requests.post(url, data=json.dumps(dict(invalid_envelope(5), nodes={}))).status_code == 400
+    assert exchange.partials() == []
+
+    valid = envelope('g', Shard(1, 2, SHARD_BY_TRACE_ID), partial_of('a', 'api', 2))
+    assert requests.post(url, data=json.dumps(valid)).status_code == 201
+    assert len(exchange.partials()) == 1
+    exchange._server.shutdown()
+    exchange._server.server_close()
+
+
+def test_directory_exchange_skip_invalid_partial(tmp_path):
+    exchange = DirectoryExchange('g', Shard(0, 2, SHARD_BY_TRACE_ID), str(tmp_path))
+    exchange.publish(partial_of('a', 'api', 2))
+    with open(os.path.join(tmp_path, 'g-shard-1.json'), 'w') as stream:
+        stream.write(json.dumps(invalid_envelope(1))[:-10])
+
+    partials = exchange.partials()
+    assert [data['shard'] for data in partials] == [0]
+
+
+def test_merger_skip_invalid_partial():
+    shard = Shard(0, 2, SHARD_BY_TRACE_ID)
+    valid = envelope('g', shard, partial_of('a', 'api', 2))
+    merger = Merger('g', shard, StaticExchange([valid, invalid_envelope(1)]), wait=0)
+
+    nodes, edges = merger.merge()
+    assert sorted(node.id for node in nodes) == ['a', 'root']
+    assert len(edges) == 1
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2022  Anders Håål and Redbridge AB
+
+    This file is part of tta - Tempo trace aggregation.
+
+    indis is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    indis is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with tta.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from hashlib import md5
+
+import pytest
+
+from tempo_trace_aggregation.benchmark import generate
+from tempo_trace_aggregation.spans import SpanBuffer, OTHER_TITLE, OTHER_SUB_TITLE, np
+
+
+def fill(buffer: SpanBuffer, traces: int = 200, spans_per_trace: int = 20) -> SpanBuffer:
+    """
+    Fill the buffer with generated spans, every service has a service node as the parent of the root spans and
+    some spans have a parent that is not in the buffer
+    """
+    for index, span in enumerate(generate(traces, spans_per_trace, seed=7)):
+        service_node_id = md5(str.encode(f"{span['service']}##service")).hexdigest()
+        service_node = buffer.node(span['service'], 'Service Node', service_node_id, service=True)
+        buffer.bind(service_node_id, service_node)
+        parent_span_id = span.get('parentSpanId', service_node_id)
+        if index % 97 == 0:
+            parent_span_id = f"missing-{index}"
+        buffer.append(buffer.node(span['service'], span['name']), span['spanId'], parent_span_id, service_node,
+                      int(span['startTimeUnixNano']), int(span['endTimeUnixNano']))
+    return buffer
+
+
+@pytest.mark.skipif(np is None, reason="numpy is not installed")
+def test_numpy_and_python_aggregation_are_equal():
+    buffer = fill(SpanBuffer())
+
+    counts, durations, edges, missing = buffer._aggregate_numpy()
+    py_counts, py_durations, py_edges, py_missing = buffer._aggregate_python()
+
+    assert counts == py_counts
+    assert durations == pytest.approx(py_durations)
+    assert edges == py_edges
+    assert missing == py_missing
+    assert len(missing) == len(range(0, len(buffer), 97))
+
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+def test_aggregate(use_numpy):
+    buffer = SpanBuffer(use_numpy=use_numpy)
+    root = buffer.node('frontend', 'GET /')
+    child = buffer.node('api', 'query')
+    buffer.append(root, 'a', start=0, end=2000000)
+    buffer.append(child, 'b', 'a', start=0, end=1000000)
+    buffer.append(child, 'c', 'a', start=0, end=3000000)
+    buffer.append(child, 'd', 'x')
+
+    counts, durations, edges, missing = buffer.aggregate()
+    assert counts == [1, 3]
+    assert durations == pytest.approx([2.0, 4.0])
+    # Two child spans of the same parent span is one edge count
+    assert edges == {(root, child): 1}
+    assert missing == ['x']
+
+
+def test_span_named_like_the_service_node_is_not_the_service_node():
+    buffer = SpanBuffer()
+    service_node_id = md5(str.encode("frontend##service")).hexdigest()
+    service_node = buffer.node('frontend', 'Service Node', service_node_id, service=True)
+    span_node = buffer.node('frontend', 'Service Node')
+
+    assert span_node != service_node
+    assert buffer.node_ids[span_node] == md5(str.encode("frontend##Service Node")).hexdigest()
+    assert buffer.services == [True, False]
+    # The explicit id always resolve to the service node
+    assert buffer.node('frontend', 'Service Node', service_node_id, service=True) == service_node
+
+
+def service_node(buffer: SpanBuffer, service: str) -> int:
+    return buffer.node(service, 'Service Node', md5(str.encode(f"{service}##service")).hexdigest(), service=True)
+
+
+def test_service_nodes_are_never_collapsed():
+    buffer = SpanBuffer(max_nodes=3, reserved_services=4)
+    for service in ('frontend', 'api', 'db', 'cache'):
+        buffer.node(service, 'query')
+        service_node(buffer, service)
+
+    assert sum(buffer.services) == 4
+    assert buffer.collapsed == 4
+
+
+def test_node_count_is_bounded_by_max_nodes():
+    services = ['frontend', 'api', 'db']
+    buffer = SpanBuffer(max_nodes=10, reserved_services=len(services))
+    for index in range(50):
+        service = services[index % len(services)]
+        service_node(buffer, service)
+        buffer.node(service, f"span-{index}")
+        assert len(buffer.node_ids) <= 10
+
+    assert sum(buffer.services) == len(services)
+    assert buffer.collapsed > 0
+    # Every title got at least one node, the collapsed are in the other node of the title
+    assert {buffer.titles[index] for index, service in enumerate(buffer.services) if not service} == set(services)
+    assert all(sub_title != OTHER_SUB_TITLE or title in services
+               for title, sub_title in zip(buffer.titles, buffer.sub_titles))
+
+
+def test_collapsed_node_is_not_memoized():
+    buffer = SpanBuffer(max_nodes=3)
+    query = buffer.node('api', 'query')
+    other = buffer.node('api', 'select')
+
+    assert buffer.sub_titles[other] == OTHER_SUB_TITLE
+    assert buffer.node('api', 'select') == other
+    assert buffer.node('api', 'query') == query
+    assert buffer.collapsed == 2
+
+
+def test_title_first_seen_when_full_use_the_global_other_node():
+    buffer = SpanBuffer(max_nodes=3)
+    buffer.node('api', 'query')
+    index = buffer.node('db', 'select')
+
+    assert (buffer.titles[index], buffer.sub_titles[index]) == (OTHER_TITLE, OTHER_SUB_TITLE)
+    assert buffer.node('cache', 'get') == index
+    assert len(buffer.node_ids) == 2
+    assert buffer.collapsed == 2